@@ -17,15 +17,25 @@ OUTPUT_DIR = os.path.join(BASE_DIR, 'data', 'output')
 
 # File Paths
 RAW_FILE = os.path.join(INPUT_DIR, 'semaforos_raw.geojson')
-CLEAN_FILE = os.path.join(OUTPUT_DIR, 'clean_traffic_lights.geojson')
+CLEAN_FILE = os.path.join(OUTPUT_DIR, 'clean_traffic_lights.geojsonl')
+
+# Shared HTTP session (connection pooling, gzip)
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.headers.update({
+    'User-Agent': 'OSMBrazilConflation/1.0 (user: matheusgomesms)',
+    'Accept-Encoding': 'gzip'
+})
 
 def download_data(url, save_path):
     print(f"Downloading data from {url}...")
     try:
-        r = requests.get(url, verify=False) # verify=False because gov sites often have SSL issues
-        r.raise_for_status()
-        with open(save_path, 'wb') as f:
-            f.write(r.content)
+        # verify=False because gov sites often have SSL issues
+        with HTTP_SESSION.get(url, stream=True, verify=False, timeout=60) as r:
+            r.raise_for_status()
+            # Stream to disk instead of holding the whole body in memory (iter_content also un-gzips)
+            with open(save_path, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
         print("Download successful.")
     except Exception as e:
         print(f"Error downloading: {e}")
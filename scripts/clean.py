@@ -1,65 +1,40 @@
-import json
-from datetime import datetime
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import os
 
 IGNORE_STATUS = ['DESATIVADO', 'PROJETO']
 
-def format_date(date_str):
-    if not date_str:
-        return None
-    try:
-        return datetime.strptime(date_str, "%d/%m/%Y").strftime("%Y-%m-%d")
-    except ValueError:
-        return date_str 
-
 def process_clean(input_path, output_path):
-    try:
-        with open(input_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    except FileNotFoundError:
+    # pyogrio raises DataSourceError (not FileNotFoundError) for a missing path
+    if not os.path.exists(input_path):
         print(f"Error: File {input_path} not found.")
         return
 
-    signals_features = []
-    
-    skipped_count = 0
+    gdf = gpd.read_file(input_path, engine='pyogrio')
 
-    for feature in data['features']:
-        props = feature['properties']
-        coords = feature['geometry']['coordinates']
-        
-        status = props.get('STATUS', '').upper()
-        
-        if status in IGNORE_STATUS:
-            skipped_count += 1
-            continue 
-        
-        ts_type = "signal"
-        if props.get('SEMÁFORO_EXCLUSIVO_PEDESTRE') == 'S':
-            ts_type = "pedestrian_crossing"
+    ignored = gdf['STATUS'].fillna('').str.upper().isin(IGNORE_STATUS)
+    skipped_count = int(ignored.sum())
+    gdf = gdf[~ignored]
 
-        new_props_signal = {
-            "highway": "traffic_signals",
-            "traffic_signals": ts_type,
-            "ref": props.get('CÓDIGO'),
-            "start_date": format_date(props.get('DATA_IMPLANTAÇÃO'))
-        }
+    # Dates come as DD/MM/YYYY; keep the original text when it doesn't parse
+    raw_date = gdf['DATA_IMPLANTAÇÃO']
+    parsed_date = pd.to_datetime(raw_date, format='%d/%m/%Y', errors='coerce', cache=True)
+    start_date = parsed_date.dt.strftime('%Y-%m-%d').where(parsed_date.notna(), raw_date)
 
-        # Remove keys with None values
-        new_props_signal = {k: v for k, v in new_props_signal.items() if v is not None}
+    signals = gpd.GeoDataFrame({
+        'highway': 'traffic_signals',
+        'traffic_signals': np.where(gdf['SEMÁFORO_EXCLUSIVO_PEDESTRE'].eq('S'), 'pedestrian_crossing', 'signal'),
+        'ref': gdf['CÓDIGO'],
+        'start_date': start_date
+    }, geometry=gdf.geometry.values, index=gdf.index)
 
-        signal_feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": coords
-            },
-            "properties": new_props_signal
-        }
-        signals_features.append(signal_feature)
+    # The source declares SIRGAS 2000 (EPSG:4674), which we treat as WGS84 like OSM does
+    signals = signals.set_crs(epsg=4326, allow_override=True)
 
     # Save Result to the specific output path provided by main.py
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump({"type": "FeatureCollection", "features": signals_features}, f, indent=2, ensure_ascii=False)
-    
+    # One compact feature per line (GeoJSONSeq), conflate.py reads it back with pyogrio
+    signals.to_file(output_path, driver='GeoJSONSeq', engine='pyogrio')
+
     print(f"Skipped {skipped_count} ignored items.")
-    print(f"Saved cleaned data to {output_path} ({len(signals_features)} features).")
\ No newline at end of file
+    print(f"Saved cleaned data to {output_path} ({len(signals)} features).")
@@ -1,17 +1,97 @@
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyproj
 import requests
+import shapely
+import hashlib
+import orjson
 import os
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 BUFFER_METERS = 65
 
-def get_osm_data(bbox):
+# Comma-separated output formats, e.g. FORMATS=geojson,parquet (parquet needs pyarrow)
+OUTPUT_FORMATS = [f.strip().lower() for f in os.environ.get('FORMATS', 'geojson').split(',') if f.strip()]
+
+# Overpass responses are cached on disk so reruns don't hit the API again
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'cache')
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Areas wider/taller than this are fetched in tiles; Overpass only gives us ~2 slots at once
+TILE_SIZE_DEGREES = 0.5
+OVERPASS_MAX_WORKERS = 2
+
+# Built once and reused (creating a Transformer is not cheap)
+_TO_METERS = pyproj.Transformer.from_crs(4326, 3857, always_xy=True)
+
+def _projected_points(gdf):
+    # Points in meters for the distance query only, outputs keep the original lon/lat geometry
+    xs, ys = _TO_METERS.transform(gdf.geometry.x.values, gdf.geometry.y.values)
+    return shapely.points(np.column_stack((xs, ys)))
+
+def _write_geojson(gdf, path):
+    # Compact output (no indentation or spaces), the files are served as-is to the web map
+    with open(path, 'wb') as f:
+        f.write(orjson.dumps(gdf.to_geo_dict(drop_id=True), option=orjson.OPT_APPEND_NEWLINE))
+
+def _write_parquet(gdf, path):
+    # Sort along a Hilbert curve so each row group covers a compact area
+    if len(gdf) > 1:
+        gdf = gdf.iloc[np.argsort(gdf.hilbert_distance().values, kind='stable')]
+    gdf.to_parquet(path, compression='zstd', index=False)
+
+def _write_output(gdf, path):
+    # path is the .geojson name; other formats reuse it with their own extension
+    if 'geojson' in OUTPUT_FORMATS:
+        _write_geojson(gdf, path)
+    if 'parquet' in OUTPUT_FORMATS:
+        _write_parquet(gdf, os.path.splitext(path)[0] + '.parquet')
+
+def _cache_path(bbox, query):
+    key_src = f"{round(bbox[0], 4)}_{round(bbox[1], 4)}_{round(bbox[2], 4)}_{round(bbox[3], 4)}_{query}"
+    key = hashlib.sha1(key_src.encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.json")
+
+def _read_cache(path):
+    if not os.path.exists(path):
+        return None
+    if time.time() - os.path.getmtime(path) > CACHE_TTL_SECONDS:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    except ValueError:
+        # Corrupt cache entry, just fetch again
+        return None
+
+def _write_cache(path, content):
+    # Write to a temp file first so an interrupted run never leaves a half-written entry
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _split_bbox(bbox, nx, ny):
     """
-    Fetches traffic signals from Overpass API with retries and headers.
+    Splits (minx, miny, maxx, maxy) into an nx by ny grid of tiles.
+    """
+    xs = np.linspace(bbox[0], bbox[2], nx + 1)
+    ys = np.linspace(bbox[1], bbox[3], ny + 1)
+    return [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(nx) for j in range(ny)]
+
+def _fetch_tile(bbox):
+    """
+    Fetches the Overpass elements for one bbox, using the disk cache and retries.
     """
-    print("Fetching data from OpenStreetMap (Overpass API)...")
-    
     # Use a different instance if the main one is down, or stick to main
     overpass_url = "https://overpass-api.de/api/interpreter"
     #overpass_url = "https://maps.mail.ru/osm/tools/overpass/api/interpreter"
@@ -28,22 +108,28 @@ def get_osm_data(bbox):
     out body;
     """
 
+    cache_path = _cache_path(bbox, overpass_query)
+    data = _read_cache(cache_path)
+    if data is not None:
+        print(f"Using cached Overpass response ({os.path.basename(cache_path)}).")
+        return data.get('elements', [])
+
     # Retry logic (3 attempts)
     max_retries = 3
     for attempt in range(max_retries):
         try:
             print(f"Requesting Overpass (Attempt {attempt + 1}/{max_retries})...")
             response = requests.get(overpass_url, params={'data': overpass_query}, headers=headers, timeout=60)
-            
+        
             # Check for HTTP errors (429, 500, etc.)
             response.raise_for_status()
-            
+        
             # Try to parse JSON
-            data = response.json()
-            
+            data = orjson.loads(response.content)
+        
             # If successful, break the loop
             break
-            
+        
         except Exception as e:
             print(f"Error on attempt {attempt + 1}: {e}")
             if attempt < max_retries - 1:
@@ -56,29 +142,63 @@ def get_osm_data(bbox):
                 print(f"Last response content snippet: {response.text[:200]}") # Print the error page text
                 raise ConnectionError("Could not fetch OSM data. Pipeline stopped.")
 
-    osm_features = []
-    for element in data.get('elements', []):
-        tags = element.get('tags', {})
-        osm_features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [element['lon'], element['lat']]
-            },
-            "properties": {
-                "osm_id": element['id'],
-                "ref": tags.get('ref'),
-                "start_date": tags.get('start_date')
-            }
-        })
-
-    if not osm_features:
+    # Overpass reports timeouts/out-of-memory with HTTP 200 and a 'remark'; the elements may be
+    # partial, so use them for this run only and don't cache them
+    if data.get('remark'):
+        print(f"Warning: Overpass remark: {data['remark']} (response not cached)")
+    else:
+        _write_cache(cache_path, response.content)
+    return data.get('elements', [])
+
+def get_osm_data(bbox):
+    """
+    Fetches traffic signals from Overpass API with retries and headers.
+    Large areas are split into tiles that are fetched concurrently.
+    """
+    print("Fetching data from OpenStreetMap (Overpass API)...")
+
+    nx = max(1, int(np.ceil((bbox[2] - bbox[0]) / TILE_SIZE_DEGREES)))
+    ny = max(1, int(np.ceil((bbox[3] - bbox[1]) / TILE_SIZE_DEGREES)))
+    tiles = _split_bbox(bbox, nx, ny)
+
+    if len(tiles) == 1:
+        results = [_fetch_tile(tiles[0])]
+    else:
+        print(f"Splitting area into {len(tiles)} tiles.")
+        with ThreadPoolExecutor(max_workers=OVERPASS_MAX_WORKERS) as executor:
+            results = list(executor.map(_fetch_tile, tiles))
+
+    # Tiles share their edges, so a node can come back twice
+    elements = []
+    seen_ids = set()
+    for tile_elements in results:
+        for element in tile_elements:
+            if element['id'] not in seen_ids:
+                seen_ids.add(element['id'])
+                elements.append(element)
+
+    if not elements:
         print("Warning: Overpass returned 0 traffic lights. This might be correct, or an area error.")
         return gpd.GeoDataFrame()
 
-    return gpd.GeoDataFrame.from_features(osm_features, crs="EPSG:4326")
+    count = len(elements)
+    lons = np.fromiter((e['lon'] for e in elements), dtype=np.float64, count=count)
+    lats = np.fromiter((e['lat'] for e in elements), dtype=np.float64, count=count)
+    ids = np.fromiter((e['id'] for e in elements), dtype=np.int64, count=count)
+    refs = [e.get('tags', {}).get('ref') for e in elements]
+    dates = [e.get('tags', {}).get('start_date') for e in elements]
+
+    return gpd.GeoDataFrame({
+        'osm_id': ids,
+        'ref': refs,
+        'start_date': dates
+    }, geometry=gpd.points_from_xy(lons, lats), crs="EPSG:4326")
 
 def run_conflation(input_file, output_dir):
+    unknown_formats = set(OUTPUT_FORMATS) - {'geojson', 'parquet'}
+    if unknown_formats:
+        raise ValueError(f"Unknown output format(s) in FORMATS: {', '.join(sorted(unknown_formats))}")
+
     # Define output paths inside the output directory
     out_missing = os.path.join(output_dir, '1_missing_in_osm.geojson')
     out_incomplete = os.path.join(output_dir, '2_incomplete_osm_data.geojson')
@@ -89,7 +209,8 @@ def run_conflation(input_file, output_dir):
         print(f"Error: {input_file} not found.")
         return
 
-    local_gdf = gpd.read_file(input_file)
+    # Keep dates as the YYYY-MM-DD text OSM expects, not parsed datetimes
+    local_gdf = gpd.read_file(input_file, engine='pyogrio', datetime_as_string=True)
     local_gdf = local_gdf[local_gdf.geometry.type == 'Point']
 
     # Rename columns for clarity
@@ -114,22 +235,26 @@ def run_conflation(input_file, output_dir):
 
     osm_gdf = osm_gdf.rename(columns={'ref': 'osm_ref', 'start_date': 'osm_date'})
 
-    # 3. CRS Transformation (Project to meters for buffer)
-    local_gdf_m = local_gdf.to_crs(epsg=3857)
-    osm_gdf_m = osm_gdf.to_crs(epsg=3857)
+    # 3. Deduplicate local locations (several signals can share the same point)
+    key_x = np.round(local_gdf.geometry.x.values * 1e6).astype(np.int64)
+    key_y = np.round(local_gdf.geometry.y.values * 1e6).astype(np.int64)
+    location_codes, _ = pd.factorize(pd.MultiIndex.from_arrays([key_x, key_y]))
+    _, location_first = np.unique(location_codes, return_index=True)
+    locations = local_gdf.iloc[location_first]
 
-    # 4. Buffering
-    local_gdf_m = local_gdf_m.rename_geometry('geom_point')
-    local_gdf_m['geom_buffer'] = local_gdf_m['geom_point'].buffer(BUFFER_METERS)
-    local_gdf_m_buffered = local_gdf_m.set_geometry('geom_buffer')
+    # 4. CRS Transformation (Project to meters for distance matching)
+    local_geoms = _projected_points(locations)
+    osm_geoms = _projected_points(osm_gdf)
 
-    # 5. Spatial Joins
-    joined_osm_to_local = gpd.sjoin(osm_gdf_m, local_gdf_m_buffered, how='left', predicate='within')
-    joined_local_to_osm = gpd.sjoin(local_gdf_m_buffered, osm_gdf_m, how='left', predicate='contains')
+    # 5. Spatial Matching (a single STRtree query gives every location/OSM pair within BUFFER_METERS)
+    tree = shapely.STRtree(osm_geoms)
+    location_idx, osm_idx = tree.query(local_geoms, predicate='dwithin', distance=BUFFER_METERS)
 
     # --- FILE 1: MISSING IN OSM ---
-    missing_in_osm = joined_local_to_osm[joined_local_to_osm.index_right.isna()].copy()
-    missing_in_osm = missing_in_osm.set_geometry('geom_point')
+    # Local signals whose location never showed up in a match pair
+    location_missing = np.ones(len(locations), dtype=bool)
+    location_missing[location_idx] = False
+    missing_in_osm = local_gdf.iloc[location_missing[location_codes]]
     
     # Rename back to OSM tags
     missing_in_osm = missing_in_osm.rename(columns={
@@ -139,56 +264,54 @@ def run_conflation(input_file, output_dir):
         'local_traffic_signals': 'traffic_signals'
     })
     
-    missing_in_osm = missing_in_osm[['ref', 'start_date', 'highway', 'traffic_signals', 'geom_point']]
-    missing_in_osm = missing_in_osm.rename_geometry('geometry').to_crs(epsg=4326)
-    missing_in_osm.to_file(out_missing, driver='GeoJSON')
+    missing_in_osm = missing_in_osm[['ref', 'start_date', 'highway', 'traffic_signals', 'geometry']]
+    _write_output(missing_in_osm, out_missing)
     print(f"Created {os.path.basename(out_missing)}: {len(missing_in_osm)} items.")
 
     # --- FILE 2: INCOMPLETE OSM DATA ---
-    matches = joined_osm_to_local[~joined_osm_to_local.index_right.isna()].copy()
-    incomplete_list = []
-
-    for idx, row in matches.iterrows():
-        osm_ref = row.get('osm_ref')
-        osm_date = row.get('osm_date')
-        local_ref = row.get('local_ref')
-        local_date = row.get('local_date')
-        
-        needs_update = False
-        
-        # Check Ref
-        if not pd.isna(local_ref) and str(local_ref).strip() != '':
-            if pd.isna(osm_ref) or str(osm_ref).strip() in ['', 'nan']:
-                needs_update = True
-        
-        # Check Date
-        if not pd.isna(local_date) and str(local_date).strip() != '':
-            if pd.isna(osm_date) or str(osm_date).strip() in ['', 'nan']:
-                needs_update = True
-
-        if needs_update:
-            props = {
-                "osm_id": row.get('osm_id'),
-                "ref": str(local_ref),
-                "start_date": str(local_date) if not pd.isna(local_date) else ""
-            }
-            incomplete_list.append({
-                "type": "Feature",
-                "geometry": row.geometry, 
-                "properties": props
-            })
-
-    if incomplete_list:
-        incomplete_gdf = gpd.GeoDataFrame.from_features(incomplete_list, crs="EPSG:3857").to_crs(epsg=4326)
-        incomplete_gdf.to_file(out_incomplete, driver='GeoJSON')
+    # Pair each matched OSM node with its nearest local signal
+    dist = shapely.distance(osm_geoms[osm_idx], local_geoms[location_idx])
+    order = np.lexsort((dist, osm_idx))
+    sorted_osm = osm_idx[order]
+    # First (nearest) pair of each OSM node; also fine when nothing matched
+    pair_osm, first = np.unique(sorted_osm, return_index=True)
+    pair_location = location_idx[order][first]
+
+    matches = osm_gdf.iloc[pair_osm].reset_index(drop=True)
+    local_matched = locations.iloc[pair_location].reset_index(drop=True)
+    matches['local_ref'] = local_matched['local_ref']
+    matches['local_date'] = local_matched['local_date']
+
+    local_ref = matches['local_ref'].astype('string').str.strip()
+    osm_ref = matches['osm_ref'].astype('string').str.strip()
+    local_date = matches['local_date'].astype('string').str.strip()
+    osm_date = matches['osm_date'].astype('string').str.strip()
+
+    # Local has a value that OSM is missing (empty or 'nan' counts as missing)
+    ref_missing = local_ref.notna() & (local_ref != '') & (osm_ref.isna() | osm_ref.isin(['', 'nan']))
+    date_missing = local_date.notna() & (local_date != '') & (osm_date.isna() | osm_date.isin(['', 'nan']))
+    needs_update = (ref_missing | date_missing).fillna(False).astype(bool)
+
+    incomplete_gdf = (
+        matches.loc[needs_update]
+        .assign(
+            ref=lambda d: d['local_ref'].astype(str),
+            start_date=local_date.loc[needs_update].fillna('')
+        )[['osm_id', 'ref', 'start_date', 'geometry']]
+    )
+
+    if not incomplete_gdf.empty:
+        _write_output(incomplete_gdf, out_incomplete)
         print(f"Created {os.path.basename(out_incomplete)}: {len(incomplete_gdf)} items.")
     else:
         print("No incomplete data found.")
 
     # --- FILE 3: EXTRA IN OSM ---
-    extra_in_osm = joined_osm_to_local[joined_osm_to_local.index_right.isna()].copy()
+    # OSM nodes that never showed up in a match pair
+    extra_mask = np.ones(len(osm_gdf), dtype=bool)
+    extra_mask[osm_idx] = False
+    extra_in_osm = osm_gdf.iloc[extra_mask]
     extra_in_osm = extra_in_osm.rename(columns={'osm_ref': 'ref', 'osm_date': 'start_date'})
     extra_in_osm = extra_in_osm[['osm_id', 'ref', 'start_date', 'geometry']]
-    extra_in_osm = extra_in_osm.to_crs(epsg=4326)
-    extra_in_osm.to_file(out_extra, driver='GeoJSON')
+    _write_output(extra_in_osm, out_extra)
     print(f"Created {os.path.basename(out_extra)}: {len(extra_in_osm)} items.")
\ No newline at end of file